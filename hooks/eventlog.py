@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+#structured timing log for bl2bids (opt-in with bl2bids --events <path>)
+#
+#each filesystem / nifti operation is logged as a json line
+#  {"event": "op", "op": "link", "path": .., "src": .., "phase": .., "start": .., "duration": .., "errno": ..}
+#each phase (see bl2bids.py) is logged when it ends
+#  {"event": "phase", "phase": "inputs", "start": .., "duration": ..}
+#and the last line is a summary with totals for each phase / operation and the slowest operations
+#  {"event": "summary", "phases": {..}, "ops": {..}, "slowest": [..]}
+#start and duration are in seconds (start is relative to when the log was opened)
+#
+#when the log is not enabled, timed() and phase() do nothing (timed() returns a dummy context)
+
+import heapq
+import json
+import threading
+import time
+
+_log = None
+
+class _Nothing:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def set(self, **fields):
+        pass
+
+_nothing = _Nothing()
+
+class _Log:
+    def __init__(self, path, slowest):
+        self.file = open(path, "w")
+        self.lock = threading.Lock() #executor runs operations in threads
+        self.opened = time.perf_counter()
+        self.phase = None
+        self.phase_start = None
+        self.phases = {} #name > {"duration", "ops", "op_time"}
+        self.ops = {} #op > {"count", "errors", "total", "max"}
+        self.slowest = slowest
+        self.heap = [] #(duration, seq, event) of the slowest op events so far
+        self.seq = 0
+
+    def write(self, event):
+        self.file.write(json.dumps(event)+"\n")
+
+class _Timer:
+    def __init__(self, log, op, path, fields):
+        self.log = log
+        self.event = {"event": "op", "op": op, "path": path}
+        self.event.update(fields)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def set(self, **fields):
+        #add fields to the event (like the outcome of the operation)
+        self.event.update(fields)
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        log = self.log
+        event = self.event
+        event["errno"] = getattr(exc, "errno", None) if exc is not None else None
+        event["start"] = round(self.start - log.opened, 6)
+        event["duration"] = round(end - self.start, 6)
+        with log.lock:
+            event["phase"] = log.phase
+            log.write(event)
+            log.seq += 1
+            heapq.heappush(log.heap, (event["duration"], log.seq, event))
+            if len(log.heap) > log.slowest:
+                heapq.heappop(log.heap)
+            op = log.ops.setdefault(event["op"], {"count": 0, "errors": 0, "total": 0, "max": 0})
+            op["count"] += 1
+            op["total"] += end - self.start
+            op["max"] = max(op["max"], end - self.start)
+            if exc is not None:
+                op["errors"] += 1
+            if log.phase is not None:
+                stats = log.phases[log.phase]
+                stats["ops"] += 1
+                stats["op_time"] += end - self.start
+        return False
+
+def open_log(path, slowest=10):
+    '''
+    Starts logging to path. The summary lists the slowest operations (up to slowest of them)
+    '''
+    global _log
+    _log = _Log(path, slowest)
+
+def timed(op, path, **fields):
+    '''
+    Context manager that logs op on path (with extra fields) and how long it took
+    '''
+    if _log is None:
+        return _nothing
+    return _Timer(_log, op, path, fields)
+
+def phase(name):
+    '''
+    Ends the current phase (if any) and starts phase name (None to just end the current one).
+    Operations logged until the next phase() call are counted as part of it
+    '''
+    if _log is None:
+        return
+    now = time.perf_counter()
+    with _log.lock:
+        if _log.phase is not None:
+            _log.phases[_log.phase]["duration"] += now - _log.phase_start
+            _log.write({"event": "phase", "phase": _log.phase, "start": round(_log.phase_start - _log.opened, 6),
+                "duration": round(now - _log.phase_start, 6)})
+        _log.phase = name
+        _log.phase_start = now
+        if name is not None:
+            _log.phases.setdefault(name, {"duration": 0, "ops": 0, "op_time": 0})
+
+def close_log():
+    '''
+    Writes the summary, closes the log, and returns the summary
+    '''
+    global _log
+    if _log is None:
+        return None
+    phase(None)
+    log, _log = _log, None
+    summary = {
+        "event": "summary",
+        "duration": round(time.perf_counter() - log.opened, 6),
+        "phases": dict((name, {"duration": round(p["duration"], 6), "ops": p["ops"], "op_time": round(p["op_time"], 6)})
+            for name, p in log.phases.items()),
+        "ops": dict((name, {"count": o["count"], "errors": o["errors"], "total": round(o["total"], 6), "max": round(o["max"], 6)})
+            for name, o in log.ops.items()),
+        "slowest": [event for _, _, event in sorted(log.heap, reverse=True)],
+    }
+    log.write(summary)
+    log.file.close()
+    return summary
+
+def report(summary, out):
+    #human readable version of the summary
+    out.write("bl2bids took %.3fs\n" % summary["duration"])
+    for name, p in summary["phases"].items():
+        out.write("  phase %-10s %8.3fs %6d ops (%.3fs)\n" % (name, p["duration"], p["ops"], p["op_time"]))
+    for name, o in sorted(summary["ops"].items(), key=lambda i: -i[1]["total"]):
+        out.write("  op %-13s %6d calls %8.3fs total %8.4fs max %d errors\n" % (name, o["count"], o["total"], o["max"], o["errors"]))
+    out.write("  slowest operations:\n")
+    for e in summary["slowest"]:
+        out.write("    %.4fs %s %s%s\n" % (e["duration"], e["op"], e["path"], " (errno %d)" % e["errno"] if e["errno"] else ""))
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+#runs the list of filesystem operations (plan) generated by bl2bids
+#
+#each operation is a dict with "op" and "dest" (and "src" / "data" depending on op)
+#  mkdir      : create dest directory (and parents)
+#  link       : place src at dest - hard-link it if we can, otherwise reflink, symlink, or copy it
+#               (see place())
+#  symlink    : create symlink dest pointing to src (src is relative to dest)
+#  rename     : rename src to dest
+#  write_json : write data as json to dest
+#  remove     : remove dest (output from previous run that is no longer generated)
+#
+#if op has "replace" set, existing dest is removed before it's re-created
+
+import errno
+import fcntl
+import json
+import os
+import shutil
+import sys
+import concurrent.futures
+
+import eventlog
+
+#number of threads to run operations with. most operations just wait on metadata server
+#on network filesystems, so we can overlap many of them
+THREADS = 8
+
+#ioctl to reflink (share extents of) a file on filesystems that support it (btrfs, xfs, ..)
+FICLONE = 0x40049409
+
+#how much to copy with each copy_file_range call
+COPY_CHUNK = 64*1024*1024
+
+#ways to place a file, in order of preference
+METHODS = ["hardlink", "reflink", "symlink", "copy"]
+
+#errors that mean the method is not supported between the two filesystems (so we don't try it again)
+UNSUPPORTED = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS)
+
+#errors that mean the method can't be used for this file (so we try the next one). EPERM could be
+#either, but hard-linking someone else's file with protected_hardlinks set is also EPERM
+FALLBACK = UNSUPPORTED + (errno.EPERM, errno.EMLINK, errno.EACCES)
+
+#(src device, dest device) > index of the first method in METHODS worth trying. Each pair is
+#probed by the first file placed between them. Threads might probe the same pair at the same time,
+#but that only means a few extra attempts
+_capability = {}
+
+#directory > device
+_devices = {}
+
+#operations are run in stages.. operations within the same stage don't depend on each other
+STAGES = [["remove"], ["mkdir"], ["link", "symlink", "write_json"], ["rename"]]
+
+def log(*args):
+    #single write so that messages from different threads don't get mixed up
+    sys.stdout.write(" ".join(str(arg) for arg in args)+"\n")
+
+def dedupe(plan):
+    '''
+    Drop operations whose dest is already claimed by an earlier operation (first one wins)
+    '''
+    claimed = set()
+    deduped = []
+    for op in plan:
+        if op["op"] == "rename":
+            if op["src"] == op["dest"]:
+                continue #already named correctly
+            claimed.discard(op["src"])
+        if op["op"] != "mkdir":
+            if op["dest"] in claimed:
+                log(op["dest"], "already exists (or failed to link)")
+                continue
+            claimed.add(op["dest"])
+        deduped.append(op)
+    return deduped
+
+def device(path):
+    dirname = os.path.dirname(path) or "."
+    if dirname not in _devices:
+        _devices[dirname] = os.stat(dirname).st_dev
+    return _devices[dirname]
+
+def reflink(src, dest):
+    with open(src, "rb") as fsrc:
+        fd = os.open(dest, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0o666)
+        try:
+            fcntl.ioctl(fd, FICLONE, fsrc.fileno())
+        except OSError:
+            os.close(fd)
+            os.unlink(dest)
+            raise
+        os.close(fd)
+    shutil.copymode(src, dest)
+
+def copy(src, dest):
+    with open(src, "rb") as fsrc:
+        fd = os.open(dest, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0o666)
+        try:
+            with open(fd, "wb", closefd=True) as fdst:
+                try:
+                    #copied by the kernel (or the storage server on nfs 4.2 / cifs)
+                    while os.copy_file_range(fsrc.fileno(), fdst.fileno(), COPY_CHUNK) > 0:
+                        pass
+                except (AttributeError, OSError) as e:
+                    #python < 3.8, or kernel < 5.3 for copy across filesystems
+                    if isinstance(e, OSError) and e.errno not in FALLBACK:
+                        raise
+                    fsrc.seek(0)
+                    fdst.seek(0)
+                    fdst.truncate()
+                    shutil.copyfileobj(fsrc, fdst, COPY_CHUNK)
+        except BaseException:
+            os.unlink(dest)
+            raise
+    shutil.copymode(src, dest)
+
+def place(src, dest):
+    '''
+    Make src available at dest with the first method that works (see METHODS). Returns the method used
+    '''
+    key = (os.stat(src).st_dev, device(dest))
+    probing = key not in _capability
+    first = _capability.get(key, 0)
+    for i in range(first, len(METHODS)):
+        method = METHODS[i]
+        try:
+            if method == "hardlink":
+                os.link(src, dest)
+            elif method == "reflink":
+                reflink(src, dest)
+            elif method == "symlink":
+                #keep absolute path as is (it's likely on a different mount)
+                target = src if os.path.isabs(src) else os.path.relpath(src, os.path.dirname(dest))
+                os.symlink(target, dest)
+            else:
+                copy(src, dest)
+        except OSError as e:
+            if e.errno not in FALLBACK or i == len(METHODS)-1:
+                raise
+            if probing and e.errno in UNSUPPORTED:
+                first = i+1
+            continue
+        if probing:
+            _capability[key] = first
+        return method
+
+def run(op):
+    try:
+        with eventlog.timed(op["op"], op["dest"], src=op.get("src")) as event:
+            if op.get("replace") and op["op"] != "mkdir" and os.path.lexists(op["dest"]):
+                os.unlink(op["dest"])
+
+            if op["op"] == "remove":
+                log("removing", op["dest"])
+                if os.path.lexists(op["dest"]):
+                    os.unlink(op["dest"])
+            elif op["op"] == "mkdir":
+                log("creating directory", op["dest"])
+                os.makedirs(op["dest"], exist_ok=True)
+            elif op["op"] == "link":
+                method = place(op["src"], op["dest"])
+                event.set(method=method)
+                log("placed (existing)", op["src"], "to (new %s)" % method, op["dest"])
+            elif op["op"] == "symlink":
+                log("sym-linking (existing)", op["src"], "to (new symlink)", op["dest"])
+                os.symlink(op["src"], op["dest"])
+            elif op["op"] == "rename":
+                log("renaming", op["src"], "to", op["dest"])
+                os.rename(op["src"], op["dest"])
+            elif op["op"] == "write_json":
+                log("writing", op["dest"])
+                with open(op["dest"], "w") as outfile:
+                    json.dump(op["data"], outfile)
+            else:
+                raise ValueError("unknown operation "+op["op"])
+    except FileExistsError:
+        log(op["dest"], "already exists (or failed to link)")
+
+def execute(plan, threads=THREADS):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        for stage in STAGES:
+            ops = [op for op in plan if op["op"] in stage]
+            if stage == ["mkdir"]:
+                #mkdir are few and nested (parent first) so run them in order
+                for op in ops:
+                    run(op)
+            else:
+                #list() raises the first exception, if any
+                list(pool.map(run, ops))
@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+
+#parses resource requests in #PBS/#SBATCH headers of the app's main script (and from jobheader.sh)
+#and compiles them into directives for each batch scheduler
+#
+#usage: jobheader.py parse [taskdir] (prints the resources requested as json)
+#       jobheader.py compile <slurm|pbs|osg> [taskdir] (prints directives for the scheduler)
+#       jobheader.py policy <key> (prints cluster policy for this host)
+#
+#headers are parsed into a neutral model (nodes, cores, memory, walltime, gpus, ..). Directives that
+#are native to the scheduler are passed through as they are, and anything only requested through
+#the other scheduler's directives is translated. Cluster specific tweaks are set in clusters.json
+
+import fnmatch
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+
+POLICY_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "clusters.json")
+
+def main_script(taskdir="."):
+    #app can use either brainlife, or main script
+    for name in ("brainlife", "main"):
+        path = os.path.join(taskdir, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+def read_headers(taskdir=".", extra=None):
+    '''
+    Returns #PBS/#SBATCH lines from main script and the ones generated by jobheader.sh
+    (in the same order that start hooks put them in the job script)
+
+    Other lines printed by jobheader.sh are appended to extra if it's given. If jobheader.sh fails,
+    whatever it printed before failing is still used
+    '''
+    lines = []
+    main = main_script(taskdir)
+    if main:
+        with open(main, errors="replace") as f:
+            lines.extend(line.strip() for line in f)
+    if os.path.exists(os.path.join(taskdir, "jobheader.sh")):
+        try:
+            out = subprocess.check_output(["bash", "./jobheader.sh"], cwd=taskdir)
+        except subprocess.CalledProcessError as err:
+            print("jobheader: jobheader.sh failed (%s).. using what it printed so far" % err, file=sys.stderr)
+            out = err.output or b""
+        except OSError as err:
+            print("jobheader: failed to run jobheader.sh (%s)" % err, file=sys.stderr)
+            out = b""
+        generated = out.decode("utf-8", "replace").split("\n")
+        lines.extend(line.strip() for line in generated)
+        if extra is not None:
+            extra.extend(line.rstrip() for line in generated
+                    if line.strip() and not line.strip().startswith(("#PBS", "#SBATCH", "#!")))
+    return [line for line in lines if line.startswith(("#PBS", "#SBATCH"))]
+
+def parse_memory(v, default_unit="b"):
+    '''
+    Returns bytes for memory size like 16gb (pbs) or 16G (slurm). Unit is case insensitive
+    '''
+    m = re.match(r"^(\d+(?:\.\d+)?)([kmgt]?)(b?)$", v.strip().lower())
+    if not m:
+        raise ValueError("can't parse memory size: "+v)
+    unit = m.group(2) or (default_unit if not m.group(3) else "")
+    return int(float(m.group(1)) * 1024**("bkmgt".index(unit or "b")))
+
+def parse_walltime(v):
+    '''
+    Returns seconds for pbs ([[HH:]MM:]SS) or slurm (MM, MM:SS, HH:MM:SS, D-HH, D-HH:MM, D-HH:MM:SS) walltime
+    '''
+    v = v.strip()
+    days = 0
+    if "-" in v:
+        d, v = v.split("-", 1)
+        days = int(d)
+        #after D-, fields are HH[:MM[:SS]]
+        tokens = [int(t) for t in v.split(":")]
+        tokens += [0]*(3-len(tokens))
+        return days*86400 + tokens[0]*3600 + tokens[1]*60 + tokens[2]
+    tokens = [int(float(t)) for t in v.split(":")]
+    return sum(t*60**i for i, t in enumerate(reversed(tokens)))
+
+def parse_slurm_walltime(v):
+    #plain number is minutes for slurm
+    if re.match(r"^\d+$", v.strip()):
+        return int(v)*60
+    if re.match(r"^\d+:\d+$", v.strip()):
+        mins, secs = v.split(":")
+        return int(mins)*60 + int(secs)
+    return parse_walltime(v)
+
+#pbs options that don't take a value
+PBS_FLAGS = ("-V", "-h", "-I", "-X", "-z")
+
+def parse_pbs(resources, model):
+    #-l nodes=1:ppn=8:gpus=1,vmem=16gb,walltime=4:00:00 (returns resources that are not part of model)
+    unknown = []
+    for item in resources.split(","):
+        k, _, v = item.strip().partition("=")
+        if k == "nodes":
+            tokens = v.split(":")
+            if tokens[0].isdigit():
+                model["nodes"] = int(tokens[0])
+            for token in tokens[1:]:
+                tk, _, tv = token.partition("=")
+                if tk == "ppn":
+                    model["cores"] = int(tv)
+                elif tk == "gpus":
+                    model["gpus"] = int(tv)
+                else:
+                    unknown.append("nodes:"+token)
+        elif k == "ppn":
+            model["cores"] = int(v)
+        elif k in ("vmem", "mem", "pmem"):
+            model["memory"] = parse_memory(v)
+            model["memory_type"] = k
+        elif k == "walltime":
+            model["walltime"] = parse_walltime(v)
+        elif k in ("gpus", "ngpus"):
+            model["gpus"] = int(v)
+        elif k == "ncpus":
+            model["cores"] = int(v)
+        elif k == "select":
+            #pbs pro (select=1:ncpus=8:mem=16gb:ngpus=1)
+            tokens = v.split(":")
+            if tokens[0].isdigit():
+                model["nodes"] = int(tokens[0])
+            unknown += ["select:"+item for item in parse_pbs(",".join(tokens[1:]), model)]
+        else:
+            unknown.append(item)
+    return unknown
+
+def parse_sbatch(args, model, slurm):
+    #returns options that are not part of model
+    unknown = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg.startswith("--"):
+            k, eq, v = arg[2:].partition("=")
+            if not eq and i+1 < len(args) and not args[i+1].startswith("-"):
+                i += 1
+                v = args[i]
+        else:
+            k = arg[1:2]
+            v = arg[2:]
+            if not v and i+1 < len(args) and not args[i+1].startswith("-"):
+                i += 1
+                v = args[i]
+        i += 1
+
+        if k in ("N", "nodes"):
+            model["nodes"] = int(v.split("-")[0])
+        elif k in ("n", "ntasks"):
+            slurm["ntasks"] = int(v)
+        elif k in ("c", "cpus-per-task"):
+            slurm["cpus_per_task"] = int(v)
+        elif k == "ntasks-per-node":
+            slurm["ntasks"] = int(v)
+        elif k == "mem":
+            #default unit is megabytes
+            model["memory"] = parse_memory(v, "m")
+            model["memory_type"] = "mem"
+        elif k == "mem-per-cpu":
+            slurm["mem_per_cpu"] = parse_memory(v, "m")
+        elif k in ("t", "time"):
+            model["walltime"] = parse_slurm_walltime(v)
+        elif k in ("G", "gpus"):
+            model["gpus"] = int(v.split(":")[-1])
+        elif k == "gres":
+            for gres in v.split(","):
+                tokens = gres.split(":")
+                if tokens[0] == "gpu":
+                    model["gpus"] = int(tokens[-1]) if len(tokens) > 1 and tokens[-1].isdigit() else 1
+                else:
+                    unknown.append("--gres="+gres)
+        elif k in ("p", "partition"):
+            model["partition"] = v
+        elif k in ("A", "account"):
+            model["account"] = v
+        elif k in ("J", "job-name"):
+            model["name"] = v
+        else:
+            unknown.append(arg)
+    return unknown
+
+def parse_line(line, model, slurm):
+    #parse a #PBS/#SBATCH line into model (raises ValueError/IndexError if it's malformed)
+    #returns options that are not part of model
+    tokens = line.split("#", 2)[1].split() if line.startswith("#") else []
+    if not tokens:
+        return []
+    unknown = []
+    if tokens[0] == "PBS":
+        args = tokens[1:]
+        i = 0
+        while i < len(args):
+            arg = args[i]
+            i += 1
+            opt, v = arg[:2], arg[2:]
+            if not v and opt not in PBS_FLAGS and i < len(args) and not args[i].startswith("-"):
+                v = args[i]
+                i += 1
+            if opt == "-l" and v:
+                #resources in nodes=/select= can't be requested on their own (so they are not options)
+                for item in parse_pbs(v, model):
+                    unknown.append(item if item.startswith(("nodes:", "select:")) else "-l "+item)
+            elif opt == "-q" and v:
+                model["partition"] = v
+            elif opt == "-A" and v:
+                model["account"] = v
+            elif opt == "-N" and v:
+                model["name"] = v
+            else:
+                unknown.append((opt+" "+v).strip())
+    elif tokens[0] == "SBATCH":
+        unknown = parse_sbatch(tokens[1:], model, slurm)
+        if "ntasks" in slurm or "cpus_per_task" in slurm:
+            model["cores"] = slurm.get("ntasks", 1)*slurm.get("cpus_per_task", 1)
+        if "mem_per_cpu" in slurm:
+            model["memory"] = slurm["mem_per_cpu"]*(model["cores"] or 1)
+            model["memory_type"] = "mem"
+    return unknown
+
+def parse(lines, malformed=None, untranslated=None):
+    '''
+    Returns neutral resource model from #PBS/#SBATCH header lines
+
+    {"nodes", "cores" (per node), "memory" (bytes), "walltime" (seconds), "gpus"}
+    and "memory_type" (vmem/mem/pmem) and "partition"/"account"/"name" if set. Later lines take precedence.
+    Anything not requested is None. Lines that can't be parsed are skipped (and appended to malformed
+    as (line, error) if it's given). Lines with options that are not part of the model are appended to
+    untranslated as (line, options) if it's given
+    '''
+    model = {"nodes": None, "cores": None, "memory": None, "walltime": None, "gpus": None}
+    #ntasks/cpus-per-task/mem-per-cpu could be set on separate lines
+    slurm = {}
+    for line in lines:
+        #parse into copies so that a malformed line doesn't leave half of it in the model
+        m, s = dict(model), dict(slurm)
+        try:
+            unknown = parse_line(line, m, s)
+        except (ValueError, IndexError) as err:
+            if malformed is not None:
+                malformed.append((line, err))
+            continue
+        model, slurm = m, s
+        if unknown and untranslated is not None:
+            untranslated.append((line, unknown))
+    return model
+
+def load_policy(hostname=None, path=POLICY_PATH):
+    '''
+    Returns policy for this host from clusters.json (merged from all entries with matching hostname pattern)
+
+    {"sbatch_opt": extra sbatch options, "login_shell": run job script with bash --login,
+    "pbs_memory": pbs resource to request memory with (vmem), "ignore": resources not to request}
+    IGNORE_PPN/IGNORE_VMEM/IGNORE_NODES env are added to "ignore"
+    '''
+    if hostname is None:
+        hostname = socket.gethostname()
+    policy = {"sbatch_opt": "", "login_shell": False, "pbs_memory": "vmem", "ignore": []}
+    try:
+        with open(path) as f:
+            clusters = json.load(f)
+    except FileNotFoundError:
+        clusters = []
+    for cluster in clusters:
+        if not fnmatch.fnmatch(hostname, cluster["hostname"]):
+            continue
+        for k, v in cluster.items():
+            if k == "ignore":
+                policy["ignore"] += v
+            elif k == "sbatch_opt":
+                policy["sbatch_opt"] = (policy["sbatch_opt"]+" "+v).strip()
+            elif k != "hostname":
+                policy[k] = v
+    for env, resource in (("IGNORE_PPN", "ppn"), ("IGNORE_VMEM", "vmem"), ("IGNORE_NODES", "nodes")):
+        if os.environ.get(env):
+            policy["ignore"].append(resource)
+    return policy
+
+def format_walltime(secs, days_sep=None):
+    days, secs = divmod(secs, 86400)
+    hms = "%02d:%02d:%02d" % (secs//3600, secs//60%60, secs%60)
+    if days and days_sep:
+        return "%d%s%s" % (days, days_sep, hms)
+    return "%d:%02d:%02d" % (days*24+secs//3600, secs//60%60, secs%60)
+
+def megabytes(v):
+    return int(-(-v//(1024*1024)))
+
+def rename_ignored(line, ignore):
+    #rename resources that this cluster wants us to ignore (ppn= > ppn_old=) so that the scheduler won't read them
+    for resource in ignore:
+        line = re.sub(r"(?<![\w-])%s=" % re.escape(resource), resource+"_old=", line)
+    return line
+
+NATIVE = {"slurm": "#SBATCH", "pbs": "#PBS", "osg": None}
+
+def compile(lines, backend, policy, extra=None):
+    '''
+    Returns directives for backend (slurm, pbs or osg) from #PBS/#SBATCH header lines
+
+    extra (other lines printed by jobheader.sh) are appended after the directives as they are
+    '''
+    native = NATIVE[backend]
+    ignore = policy["ignore"]
+    directives = [line for line in lines if native and line.startswith(native)]
+    given = parse(directives)
+    directives = [rename_ignored(line, ignore) for line in directives]
+    malformed = []
+    untranslated = []
+    model = parse([line for line in lines if not (native and line.startswith(native))], malformed, untranslated)
+
+    #pass lines we can't translate as they are (scheduler might still understand them)
+    for line, err in malformed:
+        print("jobheader: failed to parse \"%s\" (%s).. passing it through as is" % (line, err), file=sys.stderr)
+        directives.append(rename_ignored(line, ignore))
+
+    #sbatch understands #PBS options too, so pass the options we don't translate (but not the resources
+    #we do, or they would be requested twice). Other schedulers ignore the other scheduler's directives,
+    #so let the user know what's not requested
+    for line, unknown in untranslated:
+        options = []
+        if backend == "slurm" and line.startswith("#PBS"):
+            options = [opt for opt in unknown if opt.startswith("-")]
+            if options:
+                directives.append(rename_ignored("#PBS "+" ".join(options), ignore))
+        dropped = [opt for opt in unknown if opt not in options]
+        if dropped:
+            print("jobheader: %s is not supported on %s (ignoring it)" % (" ".join(dropped), backend), file=sys.stderr)
+
+    #drop what's already requested natively, and resources that this cluster wants us to ignore
+    for k in list(model):
+        if k == "memory_type":
+            continue
+        if given.get(k) is not None:
+            model[k] = None
+    if "ppn" in ignore:
+        model["cores"] = None
+    if "nodes" in ignore:
+        model["nodes"] = None
+    if model.get("memory_type", "vmem") in ignore:
+        model["memory"] = None
+
+    if backend == "slurm":
+        if model["nodes"]:
+            directives.append("#SBATCH --nodes=%d" % model["nodes"])
+        if model["cores"]:
+            directives.append("#SBATCH --ntasks-per-node=%d" % model["cores"])
+        if model["memory"]:
+            if model.get("memory_type") == "pmem":
+                directives.append("#SBATCH --mem-per-cpu=%dM" % megabytes(model["memory"]))
+            else:
+                directives.append("#SBATCH --mem=%dM" % megabytes(model["memory"]))
+        if model["walltime"]:
+            directives.append("#SBATCH --time=%s" % format_walltime(model["walltime"], "-"))
+        if model["gpus"]:
+            directives.append("#SBATCH --gres=gpu:%d" % model["gpus"])
+        if model.get("partition"):
+            directives.append("#SBATCH --partition=%s" % model["partition"])
+        if model.get("account"):
+            directives.append("#SBATCH --account=%s" % model["account"])
+        if model.get("name"):
+            directives.append("#SBATCH --job-name=%s" % model["name"])
+
+    elif backend == "pbs":
+        if model["nodes"] or model["cores"] or model["gpus"]:
+            nodes = "nodes=%d" % (model["nodes"] or 1)
+            if model["cores"]:
+                nodes += ":ppn=%d" % model["cores"]
+            if model["gpus"]:
+                nodes += ":gpus=%d" % model["gpus"]
+            directives.append("#PBS -l "+nodes)
+        if model["memory"]:
+            directives.append("#PBS -l %s=%dmb" % (policy["pbs_memory"], megabytes(model["memory"])))
+        if model["walltime"]:
+            directives.append("#PBS -l walltime=%s" % format_walltime(model["walltime"]))
+        if model.get("partition"):
+            directives.append("#PBS -q %s" % model["partition"])
+        if model.get("account"):
+            directives.append("#PBS -A %s" % model["account"])
+        if model.get("name"):
+            directives.append("#PBS -N %s" % model["name"])
+
+    elif backend == "osg":
+        #condor submit commands (walltime is not something we can request on osg)
+        if model["cores"]:
+            directives.append("request_cpus = %d" % model["cores"])
+        if model["memory"]:
+            directives.append("request_memory = %d" % megabytes(model["memory"]))
+        if model["gpus"]:
+            directives.append("request_gpus = %d" % model["gpus"])
+
+    #start hooks used to put everything jobheader.sh prints in the job script, so keep doing that
+    #(after the directives, as schedulers stop reading directives at the first command)
+    if extra:
+        if backend == "osg":
+            print("jobheader: ignoring lines from jobheader.sh that are not #PBS/#SBATCH on osg", file=sys.stderr)
+        else:
+            directives += extra
+
+    return directives
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "compile" and len(sys.argv) > 2 and sys.argv[2] in NATIVE:
+        taskdir = sys.argv[3] if len(sys.argv) > 3 else "."
+        extra = []
+        lines = read_headers(taskdir, extra)
+        for line in compile(lines, sys.argv[2], load_policy(), extra):
+            print(line)
+    elif len(sys.argv) == 3 and sys.argv[1] == "policy":
+        v = load_policy().get(sys.argv[2])
+        if isinstance(v, bool):
+            v = "true" if v else ""
+        elif isinstance(v, list):
+            v = " ".join(v)
+        print(v if v is not None else "")
+    elif len(sys.argv) > 1 and sys.argv[1] == "parse":
+        taskdir = sys.argv[2] if len(sys.argv) > 2 else "."
+        json.dump(parse(read_headers(taskdir)), sys.stdout)
+        print()
+    else:
+        print("usage: jobheader.py parse [taskdir] | compile <slurm|pbs|osg> [taskdir] | policy <key>", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+#writes a flat index of the files that bl2bids generates (opt-in with bl2bids --layout)
+#
+#each row lists a file under bids/ with its entities (as named by pybids), datatype, suffix,
+#extension and the metadata from its json sidecar (as a json string). Downstream apps can load
+#it (pandas.read_csv(..., sep="\t") or the csv module) instead of crawling bids/ and parsing
+#every json file. Everything is taken from the plan, so nothing is read back from bids/.
+#Derivatives are not listed (pybids doesn't index them by default either).
+
+import csv
+import json
+import os
+
+import utils
+
+NAME = "_bl2bids.layout.tsv"
+
+#entity prefix used in file names > pybids entity name
+ENTITIES = [
+    ("sub", "subject"),
+    ("ses", "session"),
+    ("task", "task"),
+    ("acq", "acquisition"),
+    ("rec", "reconstruction"),
+    ("dir", "direction"),
+    ("run", "run"),
+    ("proc", "proc"),
+    ("echo", "echo"),
+    ("space", "space"),
+    ("desc", "desc"),
+]
+
+COLUMNS = ["path"] + [name for _, name in ENTITIES] + ["datatype", "suffix", "extension", "metadata"]
+
+def parse(path):
+    '''
+    Returns {column: value} for bids path (like bids/sub-01/anat/sub-01_T1w.nii.gz)
+    '''
+    dirname, filename = os.path.split(path)
+    stem, dot, ext = filename.partition(".")
+    row = {"path": os.path.relpath(path, "bids"), "extension": dot+ext}
+    prefixes = dict(ENTITIES)
+    for token in stem.split("_"):
+        key, dash, value = token.partition("-")
+        if dash and key in prefixes:
+            row[prefixes[key]] = value
+        elif not dash:
+            row["suffix"] = token
+    if dirname != "bids":
+        row["datatype"] = os.path.basename(dirname)
+    return row
+
+def sidecar(path):
+    #json sidecar that holds metadata for path (sub-01_T1w.nii.gz > sub-01_T1w.json)
+    dirname, filename = os.path.split(path)
+    return os.path.join(dirname, filename.split(".")[0]+".json")
+
+def build(plan):
+    '''
+    Returns rows for each file generated by plan
+    '''
+    files = []
+    metadata = {} #json path > content
+    for op in plan:
+        dest = op["dest"]
+        if not dest.startswith("bids/") or dest.startswith("bids/derivatives/"):
+            continue
+        if ".ds/" in dest:
+            #files inside CTF .ds directory are part of the .ds "file"
+            continue
+        if op["op"] == "mkdir":
+            if dest.endswith(".ds"):
+                files.append(dest)
+            continue
+        files.append(dest)
+        if op["op"] == "write_json":
+            metadata[dest] = op["data"]
+        elif op["op"] == "link" and dest.endswith(".json"):
+            try:
+                metadata[dest] = utils.loadJSON(op["src"])
+            except ValueError:
+                print("failed to parse", op["src"])
+
+    rows = []
+    for path in sorted(set(files)):
+        row = parse(path)
+        if not path.endswith(".json"):
+            row["metadata"] = json.dumps(metadata.get(sidecar(path), {}), sort_keys=True)
+        rows.append(row)
+    return rows
+
+def save(rows, path=NAME):
+    #write to temp file and rename so we won't leave half written index
+    with open(path+".tmp", "w", newline="") as f:
+        writer = csv.DictWriter(f, COLUMNS, restval="n/a", delimiter="\t", lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+    os.replace(path+".tmp", path)
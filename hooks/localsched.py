@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+#minimal resource-aware scheduler for tasks started by direct/start
+#
+#usage: localsched.py acquire --pid <pid> [--taskdir .] (blocks until the task can run)
+#       localsched.py release --pid <pid>
+#       localsched.py show
+#
+#tasks queue in a ledger shared by all tasks on this host (LOCALSCHED_DIR). A task is started in
+#FIFO order once the cores/memory it requests (in #PBS/#SBATCH headers) are free. A task that asks for
+#more than the host has is started once nothing else is running. Tasks are tracked by the pid of
+#the process that runs them so tasks that get killed (by direct/stop, or otherwise) are removed from
+#the ledger automatically.
+
+import argparse
+import fcntl
+import json
+import os
+import sys
+import time
+
+import jobheader
+
+LEDGER_DIR = os.environ.get("LOCALSCHED_DIR", os.path.expanduser("~/.cache/brainlife/localsched"))
+
+#how often to check if we can run (seconds)
+INTERVAL = 5
+
+def capacity():
+    cores = int(os.environ.get("LOCALSCHED_CORES", os.cpu_count() or 1))
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    if "LOCALSCHED_MEMORY" in os.environ:
+        memory = jobheader.parse_memory(os.environ["LOCALSCHED_MEMORY"])
+    return cores, memory
+
+def starttime(pid):
+    with open("/proc/%d/stat" % pid) as f:
+        stat = f.read()
+    return int(stat[stat.rfind(")")+2:].split()[19])
+
+def alive(pid, start):
+    #make sure pid is not reused by some other process
+    try:
+        return starttime(pid) == start
+    except OSError:
+        return False
+
+class Ledger:
+    '''
+    {"queue": [task], "running": [task]} stored in a json file and only accessed while holding flock
+    '''
+    def __init__(self, path=None):
+        os.makedirs(LEDGER_DIR, exist_ok=True)
+        self.path = path or os.path.join(LEDGER_DIR, "ledger.json")
+        self.lock = None
+
+    def __enter__(self):
+        self.lock = open(self.path+".lock", "w")
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {"queue": [], "running": []}
+        #forget tasks that are gone
+        for k in ("queue", "running"):
+            self.data[k] = [task for task in self.data[k] if alive(task["pid"], task["starttime"])]
+        return self
+
+    def __exit__(self, *args):
+        with open(self.path+".tmp", "w") as f:
+            json.dump(self.data, f)
+        os.replace(self.path+".tmp", self.path)
+        self.lock.close()
+
+    def find(self, pid):
+        for k in ("queue", "running"):
+            for task in self.data[k]:
+                if task["pid"] == pid:
+                    return k, task
+        return None, None
+
+    def admit(self, pid):
+        '''
+        Moves task to running if it's at the head of the queue and there is enough room
+        '''
+        state, task = self.find(pid)
+        if state != "queue":
+            return state == "running"
+        if self.data["queue"][0]["pid"] != pid:
+            return False
+        cores, memory = capacity()
+        running = self.data["running"]
+        used_cores = sum(t["cores"] for t in running)
+        used_memory = sum(t["memory"] for t in running)
+        if running and (used_cores + task["cores"] > cores or used_memory + task["memory"] > memory):
+            return False
+        self.data["queue"].pop(0)
+        running.append(task)
+        return True
+
+def acquire(pid, taskdir):
+    model = jobheader.parse(jobheader.read_headers(taskdir))
+    task = {
+        "pid": pid,
+        "starttime": starttime(pid),
+        "dir": os.path.abspath(taskdir),
+        "cores": (model["cores"] or 1)*(model["nodes"] or 1),
+        "memory": model["memory"] or 0,
+        "queued": time.time(),
+    }
+    with Ledger() as ledger:
+        if ledger.find(pid)[0] is None:
+            ledger.data["queue"].append(task)
+        if ledger.admit(pid):
+            return True
+        print("waiting for local resources (%d cores / %.1fGB requested, %d tasks ahead)" % (
+            task["cores"], task["memory"]/1024/1024/1024, [t["pid"] for t in ledger.data["queue"]].index(pid)), flush=True)
+
+    while True:
+        time.sleep(INTERVAL)
+        with Ledger() as ledger:
+            state, _ = ledger.find(pid)
+            if state is None:
+                #task is gone (killed while waiting)
+                return False
+            if ledger.admit(pid):
+                return True
+
+def release(pid):
+    with Ledger() as ledger:
+        for k in ("queue", "running"):
+            ledger.data[k] = [task for task in ledger.data[k] if task["pid"] != pid]
+
+def main():
+    parser = argparse.ArgumentParser(description="resource-aware local task scheduler")
+    parser.add_argument("command", choices=["acquire", "release", "show"])
+    parser.add_argument("--pid", type=int, help="pid of the process running the task")
+    parser.add_argument("--taskdir", default=".", help="task directory to read resource requests from")
+    args = parser.parse_args()
+
+    if args.command == "show":
+        with Ledger() as ledger:
+            json.dump(ledger.data, sys.stdout, indent=4)
+            print()
+        return
+
+    if args.pid is None:
+        parser.error("--pid is required")
+    if args.command == "acquire":
+        if not acquire(args.pid, args.taskdir):
+            sys.exit(1)
+        print("starting task", flush=True)
+    else:
+        release(args.pid)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+#keeps track of what bl2bids has generated so that re-running it only redo inputs that changed
+#
+#manifest lists each output path (grouped by the input that generated it) with the inode/size/mtime
+#of its source file, or the hash of json content for generated sidecars. On the next run, an input
+#is skipped if all its outputs are identical and still exist. Otherwise its old outputs are removed
+#and regenerated. Outputs that are no longer generated at all are removed.
+
+import hashlib
+import json
+import os
+
+import eventlog
+
+NAME = "_bl2bids.manifest.json"
+VERSION = 1
+
+def empty():
+    return {"version": VERSION, "inputs": {}}
+
+def load(path=NAME):
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest.get("version") == VERSION:
+            return manifest
+        print("ignoring manifest with unsupported version", manifest.get("version"))
+    except FileNotFoundError:
+        pass
+    except ValueError:
+        print("ignoring broken manifest", path)
+    return empty()
+
+def save(manifest, path=NAME):
+    #write to temp file and rename so we won't leave half written manifest
+    with open(path+".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path+".tmp", path)
+
+def record(op):
+    #returns what we need to remember about an output generated by op
+    rec = {"op": op["op"]}
+    if op["op"] == "link":
+        with eventlog.timed("stat", op["src"]):
+            st = os.stat(op["src"])
+        rec.update({"src": op["src"], "ino": st.st_ino, "size": st.st_size, "mtime": st.st_mtime_ns})
+    elif op["op"] == "symlink":
+        rec["src"] = op["src"]
+    elif op["op"] == "write_json":
+        content = json.dumps(op["data"], sort_keys=True).encode()
+        rec["sha1"] = hashlib.sha1(content).hexdigest()
+    return rec
+
+def outputs(plan):
+    '''
+    Returns {input: {output path: record}} for the final outputs generated by plan
+    '''
+    groups = {}
+    for op in plan:
+        if op["op"] == "mkdir":
+            continue
+        group = groups.setdefault(str(op["input"]), {})
+        if op["op"] == "rename":
+            rec = group.pop(op["src"], {"op": "rename"})
+            rec["renamed"] = op["src"]
+            group[op["dest"]] = rec
+        else:
+            group[op["dest"]] = record(op)
+    return groups
+
+def _exists(path):
+    with eventlog.timed("lexists", path):
+        return os.path.lexists(path)
+
+def select(plan, manifest):
+    '''
+    Compare plan against the previous manifest
+
+    Returns (ops to run, paths to remove, new manifest). Operations for inputs that are
+    re-generated are marked with "replace" so that any existing dest is removed first.
+    '''
+    new = {"version": VERSION, "inputs": outputs(plan)}
+    old = manifest["inputs"]
+
+    clean = set()
+    for group, outs in new["inputs"].items():
+        if old.get(group) == outs and all(_exists(path) for path in outs):
+            print("input", group, "is up to date.. skipping")
+            clean.add(group)
+
+    ops = []
+    for op in plan:
+        if op["op"] == "mkdir":
+            ops.append(op)
+        elif str(op["input"]) not in clean:
+            ops.append(dict(op, replace=True))
+
+    #remove outputs from previous run that we are not going to keep
+    keep = set()
+    for group in clean:
+        keep.update(new["inputs"][group])
+    generated = set()
+    for group in new["inputs"]:
+        generated.update(new["inputs"][group])
+    remove = []
+    for group, outs in old.items():
+        for path in outs:
+            if path not in keep and path not in generated:
+                remove.append(path)
+
+    return ops, remove, new
+
+def prune(paths, top="bids"):
+    #remove directories that became empty after removing paths (up to top)
+    dirs = set(os.path.dirname(path) for path in paths)
+    for path in sorted(dirs, key=len, reverse=True):
+        while path and path != top and os.path.isdir(path) and not os.path.islink(path):
+            try:
+                os.rmdir(path)
+            except OSError:
+                break #not empty
+            path = os.path.dirname(path)
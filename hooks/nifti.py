@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+#minimal NIfTI-1/NIfTI-2 header reader
+#
+#bl2bids only needs the image orientation (to fix PhaseEncodingDirection and to set _dir- label)
+#which can be derived from the qform/sform stored in the header. This lets us run bl2bids with
+#just the standard library (without nibabel/numpy, and so without a container)
+#https://nifti.nimh.nih.gov/pub/dist/src/niftilib/nifti1.h
+#https://nifti.nimh.nih.gov/pub/dist/doc/nifti2.h
+
+import gzip
+import math
+import struct
+
+#NIfTI-1 header is 348 bytes, NIfTI-2 is 540 bytes
+HEADER_SIZE = 540
+
+def readHeader(path):
+    '''
+    Returns dict with dim, pixdim, qform_code, sform_code, quatern (b, c, d, x, y, z offsets)
+    and srow (12 values of srow_x/y/z) read from the header of nifti image at path
+
+    Raises ValueError if path is not a NIfTI-1/NIfTI-2 image
+    '''
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        data = f.read(HEADER_SIZE)
+
+    for endian in ("<", ">"):
+        if len(data) >= 348 and struct.unpack(endian+"i", data[0:4])[0] == 348 and data[344:347] in (b"n+1", b"ni1"):
+            return {
+                "version": 1,
+                "dim": struct.unpack(endian+"8h", data[40:56]),
+                "pixdim": struct.unpack(endian+"8f", data[76:108]),
+                "qform_code": struct.unpack(endian+"h", data[252:254])[0],
+                "sform_code": struct.unpack(endian+"h", data[254:256])[0],
+                "quatern": struct.unpack(endian+"6f", data[256:280]),
+                "srow": struct.unpack(endian+"12f", data[280:328]),
+            }
+        if len(data) >= 540 and struct.unpack(endian+"i", data[0:4])[0] == 540 and data[4:7] in (b"n+2", b"ni2"):
+            return {
+                "version": 2,
+                "dim": struct.unpack(endian+"8q", data[16:80]),
+                "pixdim": struct.unpack(endian+"8d", data[104:168]),
+                "qform_code": struct.unpack(endian+"i", data[344:348])[0],
+                "sform_code": struct.unpack(endian+"i", data[348:352])[0],
+                "quatern": struct.unpack(endian+"6d", data[352:400]),
+                "srow": struct.unpack(endian+"12d", data[400:496]),
+            }
+
+    raise ValueError("not a NIfTI-1/NIfTI-2 image: "+path)
+
+def getAffine(hdr):
+    '''
+    Returns 4x4 affine (list of rows) from the header - sform if set, then qform,
+    then the default affine derived from the voxel size (same as nibabel's get_best_affine)
+    '''
+    if hdr["sform_code"] != 0:
+        srow = hdr["srow"]
+        return [list(srow[0:4]), list(srow[4:8]), list(srow[8:12]), [0, 0, 0, 1]]
+
+    if hdr["qform_code"] != 0:
+        b, c, d, qx, qy, qz = hdr["quatern"]
+        #a is not stored (quaternion is assumed to be normalized)
+        a2 = 1.0 - (b*b + c*c + d*d)
+        a = math.sqrt(a2) if a2 > 0 else 0.0
+        R = quat2mat(a, b, c, d)
+        qfac = hdr["pixdim"][0]
+        if qfac not in (-1, 1):
+            qfac = 1
+        zooms = [hdr["pixdim"][1], hdr["pixdim"][2], hdr["pixdim"][3]*qfac]
+        affine = [[R[i][j]*zooms[j] for j in range(3)] for i in range(3)]
+        for i, offset in enumerate((qx, qy, qz)):
+            affine[i].append(offset)
+        affine.append([0, 0, 0, 1])
+        return affine
+
+    #no transform set.. use voxel size with x flipped and center of the image at origin
+    ndim = hdr["dim"][0]
+    shape = [hdr["dim"][i+1] if i < ndim else 1 for i in range(3)]
+    zooms = [hdr["pixdim"][i+1] if i < ndim else 1.0 for i in range(3)]
+    zooms[0] *= -1
+    affine = []
+    for i in range(3):
+        row = [0.0, 0.0, 0.0, -(shape[i]-1)/2.0*zooms[i]]
+        row[i] = zooms[i]
+        affine.append(row)
+    affine.append([0, 0, 0, 1])
+    return affine
+
+def quat2mat(w, x, y, z):
+    #rotation matrix from quaternion
+    Nq = w*w + x*x + y*y + z*z
+    if Nq < 1e-12:
+        return [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]
+    s = 2.0/Nq
+    X, Y, Z = x*s, y*s, z*s
+    wX, wY, wZ = w*X, w*Y, w*Z
+    xX, xY, xZ = x*X, x*Y, x*Z
+    yY, yZ, zZ = y*Y, y*Z, z*Z
+    return [[1.0-(yY+zZ), xY-wZ, xZ+wY],
+            [xY+wZ, 1.0-(xX+zZ), yZ-wX],
+            [xZ-wY, yZ+wX, 1.0-(xX+yY)]]
+
+def polar(M):
+    #closest orthogonal matrix to M (polar decomposition by newton iteration)
+    R = [row[:] for row in M]
+    for i in range(20):
+        inv = inverse(R)
+        if inv is None:
+            return M #singular.. use as is
+        R = [[(R[r][c] + inv[c][r])/2.0 for c in range(3)] for r in range(3)]
+    return R
+
+def inverse(M):
+    (a, b, c), (d, e, f), (g, h, i) = M
+    det = a*(e*i - f*h) - b*(d*i - f*g) + c*(d*h - e*g)
+    if abs(det) < 1e-12:
+        return None
+    return [[(e*i - f*h)/det, (c*h - b*i)/det, (b*f - c*e)/det],
+            [(f*g - d*i)/det, (a*i - c*g)/det, (c*d - a*f)/det],
+            [(d*h - e*g)/det, (b*g - a*h)/det, (a*e - b*d)/det]]
+
+def aff2axcodes(affine, labels=(("L", "R"), ("P", "A"), ("I", "S"))):
+    '''
+    Returns axis codes (like ('L', 'A', 'S')) for each voxel axis of affine
+
+    Same as nibabel.aff2axcodes - each voxel axis is assigned to the world axis it's
+    most closely aligned with. Axes are processed from the most to the least aligned
+    one, and a world axis can't be used again once it's taken.
+    '''
+    #normalize columns (remove voxel size) and remove shear
+    RS = [[float(affine[i][j]) for j in range(3)] for i in range(3)]
+    for j in range(3):
+        zoom = math.sqrt(sum(RS[i][j]**2 for i in range(3))) or 1.0
+        for i in range(3):
+            RS[i][j] /= zoom
+    R = polar(RS)
+
+    codes = [None, None, None]
+    in_axes = sorted(range(3), key=lambda j: -max(R[i][j]**2 for i in range(3)))
+    for j in in_axes:
+        col = [R[i][j] for i in range(3)]
+        if all(abs(v) < 1e-8 for v in col):
+            continue
+        out_ax = max(range(3), key=lambda i: abs(col[i]))
+        codes[j] = labels[out_ax][1] if col[out_ax] > 0 else labels[out_ax][0]
+        #world axis is taken
+        for k in range(3):
+            R[out_ax][k] = 0.0
+    return tuple(codes)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+#reads smon output (either _smon.out json lines, or the compact _smon.dat stored with SMON_FORMAT=compact)
+#
+#usage: smonfile.py _smon.dat > _smon.out (export the compact format as json lines)
+#
+#compact format (see CompactFile in smon)
+#   magic "SMONDAT1"
+#   header (json of the first _smon.out line)
+#   schema (json describing the fixed width records)
+#   string table
+#   rollups (older samples rolled up into windows) followed by the recent samples
+#all integers are little endian. header, schema and strings are prefixed with u32 length
+
+import json
+import math
+import os
+import struct
+import sys
+import time
+
+MAGIC = b"SMONDAT1"
+
+def format_etime(secs):
+    #same format as ps etime ([[dd-]hh:]mm:ss)
+    secs = int(secs)
+    days, secs = divmod(secs, 86400)
+    hours, secs = divmod(secs, 3600)
+    mins, secs = divmod(secs, 60)
+    if days > 0:
+        return "%d-%02d:%02d:%02d" % (days, hours, mins, secs)
+    if hours > 0:
+        return "%02d:%02d:%02d" % (hours, mins, secs)
+    return "%02d:%02d" % (mins, secs)
+
+def parse_etime(etime):
+    #reverse of format_etime (etime is stored as seconds in the compact format)
+    days = 0
+    if "-" in etime:
+        d, etime = etime.split("-")
+        days = int(d)
+    secs = 0
+    for v in etime.split(":"):
+        secs = secs*60 + int(v)
+    return days*86400 + secs
+
+class Reader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def unpack(self, fmt):
+        values = struct.unpack_from(fmt, self.data, self.pos)
+        self.pos += struct.calcsize(fmt)
+        return values
+
+    def blob(self):
+        length, = self.unpack("<I")
+        b = self.data[self.pos:self.pos+length]
+        self.pos += length
+        return b
+
+def decode(reader, fields, strings):
+    fmt = "<" + "".join("I" if t in "spe" else t for keys, t in fields)
+    record = {}
+    for (keys, t), v in zip(fields, reader.unpack(fmt)):
+        if t == "s":
+            v = strings[v] if v != 0xffffffff else None
+        elif t == "p":
+            v = str(v)
+        elif t == "e":
+            v = format_etime(v)
+        elif t in "fd":
+            v = None if math.isnan(v) else round(v, 3) if t == "f" else v
+        elif v == -1:
+            v = None
+        parent = record
+        for k in keys[:-1]:
+            parent = parent.setdefault(k, {})
+        parent[keys[-1]] = v
+    return record
+
+def decode_list(reader, fields, strings):
+    count, = reader.unpack("<i")
+    if count == -1:
+        return None
+    return [decode(reader, fields, strings) for i in range(count)]
+
+def compact_records(data):
+    reader = Reader(data)
+    reader.pos = len(MAGIC)
+    yield json.loads(reader.blob().decode())
+    schema = json.loads(reader.blob().decode())
+    count, = reader.unpack("<I")
+    strings = [reader.blob().decode("utf-8") for i in range(count)]
+
+    count, = reader.unpack("<I")
+    for i in range(count):
+        start, end, samples = reader.unpack("<ddI")
+        rollup = {"start": start, "end": end, "samples": samples}
+        for k in schema["metrics"]:
+            lo, hi, mean = reader.unpack("<ddd")
+            if not math.isnan(mean):
+                rollup[k] = {"min": lo, "max": hi, "mean": mean}
+        yield {
+            "time": end,
+            "rollup": rollup,
+            "processes": decode_list(reader, schema["process"], strings),
+        }
+
+    count, = reader.unpack("<I")
+    for i in range(count):
+        record = decode(reader, schema["sample"], strings)
+        record["processes"] = decode_list(reader, schema["process"], strings)
+        record["disks"] = decode_list(reader, schema["disk"], strings)
+        for disk in record["disks"] or []:
+            disk["growing"] = decode_list(reader, schema["growing"], strings)
+        record["gpus"] = decode_list(reader, schema["gpu"], strings)
+        yield record
+
+def records(path):
+    '''
+    Yields records stored in smon output at path (header first, then samples in time order)
+
+    Samples that are rolled up in the compact format have "rollup" set with the window
+    (start/end/samples) and min/max/mean of the job level metrics, and the processes
+    (max of each value) that ran during the window.
+    '''
+    with open(path, "rb") as f:
+        data = f.read()
+    if data.startswith(MAGIC):
+        yield from compact_records(data)
+        return
+    for line in data.decode("utf-8").split("\n"):
+        if line.strip() == "":
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            #last line might be partially written
+            pass
+
+def find(path):
+    '''
+    Returns path of smon output in task directory path (or path itself if it's a file)
+    '''
+    if os.path.isdir(path):
+        for name in ("_smon.out", "_smon.dat"):
+            if os.path.exists(os.path.join(path, name)):
+                return os.path.join(path, name)
+        return None
+    return path
+
+def metrics(record):
+    #job level metrics of a sample (smon rolls these up in the compact format, and aggregates them for its socket)
+    disks = record.get("disks") or []
+    procs = record.get("processes") or []
+    cgroup = record.get("cgroup") or {}
+    return {
+        "memory_avail": record.get("memory_avail"),
+        "disk": disks[0]["size"] if disks else None,
+        "pcpu": sum(p["pcpu"] for p in procs),
+        "rss": sum(p["rss"] for p in procs),
+        #only if we have it for all processes (so it's not mixed with rss)
+        "pss": sum(p["pss"] for p in procs) if all(p.get("pss") is not None for p in procs) else None,
+        "memory_current": cgroup.get("memory.current"),
+        "read_bps": sum(p.get("read_bps") or 0 for p in procs),
+        "write_bps": sum(p.get("write_bps") or 0 for p in procs),
+    }
+
+def summary(path, windows=(300, 900, 3600)):
+    '''
+    Returns {"header", "latest", "aggregates"} from smon output at path in the same format that
+    smon serves over its socket (SMON_SOCKET=1). Samples rolled up in the compact format are
+    counted if their window ended within the aggregation window
+    '''
+    now = time.time()
+    header = None
+    latest = None
+    samples = [] #(time, samples, {metric: (min, max, mean)})
+    for record in records(path):
+        if header is None:
+            header = record
+        elif "rollup" in record:
+            rollup = record["rollup"]
+            values = dict((k, (v["min"], v["max"], v["mean"])) for k, v in rollup.items() if isinstance(v, dict))
+            samples.append((record["time"], rollup["samples"], values))
+        else:
+            latest = record
+            values = dict((k, (v, v, v)) for k, v in metrics(record).items() if v is not None)
+            samples.append((record["time"], 1, values))
+
+    aggregates = {}
+    for window in windows:
+        selected = [s for s in samples if s[0] >= now - window]
+        aggs = {}
+        for t, count, values in selected:
+            for k, (lo, hi, mean) in values.items():
+                agg = aggs.setdefault(k, [lo, hi, 0, 0])
+                agg[0] = min(agg[0], lo)
+                agg[1] = max(agg[1], hi)
+                agg[2] += mean*count
+                agg[3] += count
+        aggregates[str(window)] = {
+            "samples": sum(count for t, count, values in selected),
+            "metrics": dict((k, {"min": a[0], "max": a[1], "mean": a[2]/a[3]}) for k, a in aggs.items() if a[3]),
+        }
+    return {"time": now, "header": header, "latest": latest, "aggregates": aggregates}
+
+def main():
+    if len(sys.argv) != 2:
+        print("usage: smonfile.py <_smon.out or _smon.dat>", file=sys.stderr)
+        sys.exit(1)
+    for record in records(sys.argv[1]):
+        json.dump(record, sys.stdout)
+        sys.stdout.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -5,9 +5,11 @@ import pathlib
 import os
 import sys
 import re
-import nibabel as nib
 import os.path as op
 
+import eventlog
+import nifti
+
 ANAT_T1W = "58c33bcee13a50849b25879a"
 ANAT_T2W = "594c0325fa1d2e5a1f0beda5"
 DWI = "58c33c5fe13a50849b25879b"
@@ -24,33 +26,203 @@ EEG_BDF = "60007567aacf9e1615a691dd"
 #derivatives datatype > directory mapping
 DERIVATIVES_DIRNAMES = { "58cb22c8e13a50849b25882e": "freesurfer" }
 
+#datatype > how to map it to bids structure
+#  modality: bids directory (anat, func, etc..) that the datatype is stored under
+#  files: (file name in the input dir, "dest" or "short_dest", suffix appended to the dest)
+#         dest contains all entities, short_dest does not contain task and run
+#  sidecar: suffix for the json sidecar generated from the input meta
+#  intended: suffix of the file that fmap IntendedFor should point to
+#  desc: extra entity appended to dest
+#  ctf: CTF .ds directory to copy (and rename files in it)
+#datatypes not listed here (other than fmap) are treated as derivatives
+DATATYPES = {
+    ANAT_T1W: {
+        "modality": "anat",
+        "files": [("t1.nii.gz", "dest", "_T1w.nii.gz")],
+        "sidecar": "_T1w.json",
+    },
+    ANAT_T2W: {
+        "modality": "anat",
+        "files": [("t2.nii.gz", "dest", "_T2w.nii.gz")],
+        "sidecar": "_T2w.json",
+    },
+    DWI: {
+        "modality": "dwi",
+        "files": [
+            ("dwi.nii.gz", "dest", "_dwi.nii.gz"),
+            ("dwi.bvals", "dest", "_dwi.bval"),
+            ("dwi.bvecs", "dest", "_dwi.bvec"),
+            ("sbref.nii.gz", "dest", "_sbref.nii.gz"),
+            ("sbref.json", "dest", "_sbref.json"),
+        ],
+        "sidecar": "_dwi.json",
+        "intended": "_dwi.nii.gz",
+    },
+    FUNC_TASK: {
+        "modality": "func",
+        "files": [
+            ("bold.nii.gz", "dest", "_bold.nii.gz"),
+            ("events.tsv", "dest", "_events.tsv"),
+            ("events.json", "dest", "_events.json"),
+            ("sbref.nii.gz", "dest", "_sbref.nii.gz"),
+            ("sbref.json", "dest", "_sbref.json"),
+            ("physio.tsv.gz", "dest", "_physio.tsv.gz"),
+            ("physio.json", "dest", "_physio.json"),
+        ],
+        "sidecar": "_bold.json",
+        "intended": "_bold.nii.gz",
+    },
+    FUNC_REGRESSORS: {
+        "modality": "func",
+        #desc- is only for derivatives..
+        #https://github.com/bids-standard/bids-validator/issues/984
+        #can't use input id to make it unique.. it looks like
+        #https://fmriprep.org/en/stable/outputs.html#confound-regressors-description
+        #dest+="_desc-confounds%d"%(id+1) #is this bids-compliant?
+
+        #it looks like BIDS requires that regressors having "confounds" for desc?
+        "desc": "_desc-confounds",
+        "files": [("regressors.tsv", "dest", "_regressors.tsv")],
+        "sidecar": "_regressors.json",
+    },
+    FMAP: {
+        "modality": "fmap",
+        #files are handled by bl2bids based on input keys
+    },
+    MEG_CTF: {
+        "modality": "meg",
+        "ctf": ("meg.ds", "_meg.ds"),
+        "files": [
+            ("channels.tsv", "dest", "_channels.tsv"),
+            ("events.tsv", "dest", "_events.tsv"),
+            ("events.json", "dest", "_events.json"),
+            ("headshape.pos", "short_dest", "_headshape.pos"),
+            ("coordsystem.json", "short_dest", "_coordsystem.json"),
+        ],
+        "sidecar": "_meg.json",
+    },
+    MEG_FIF: {
+        "modality": "meg",
+        "files": [
+            ("meg.fif", "dest", "_meg.fif"),
+            ("channels.tsv", "dest", "_channels.tsv"),
+            ("events.tsv", "dest", "_events.tsv"),
+            ("events.json", "dest", "_events.json"),
+            ("headshape.pos", "short_dest", "_headshape.pos"),
+            ("coordsystem.json", "short_dest", "_coordsystem.json"),
+            ("calibration_meg.dat", "short_dest", "_acq-calibration_meg.dat"),
+            ("crosstalk_meg.fif", "short_dest", "_acq-crosstalk_meg.fif"),
+            ("destination.fif", "short_dest", "_destination.fif"),
+        ],
+        "sidecar": "_meg.json",
+    },
+    EEG_EEGLAB: {
+        "modality": "eeg",
+        "files": [
+            ("eeg.fdt", "dest", "_eeg.fdt"),
+            ("eeg.set", "dest", "_eeg.set"),
+            ("channels.tsv", "dest", "_channels.tsv"),
+            ("events.tsv", "dest", "_events.tsv"),
+            ("events.json", "dest", "_events.json"),
+            ("electrodes.tsv", "short_dest", "_electrodes.tsv"),
+            ("coordsystem.json", "short_dest", "_coordsystem.json"),
+        ],
+        "sidecar": "_eeg.json",
+    },
+    EEG_EDF: {
+        "modality": "eeg",
+        "files": [
+            ("eeg.edf", "dest", "_eeg.edf"),
+            ("channels.tsv", "dest", "_channels.tsv"),
+            ("events.tsv", "dest", "_events.tsv"),
+            ("events.json", "dest", "_events.json"),
+            ("electrodes.tsv", "short_dest", "_electrodes.tsv"),
+            ("coordsystem.json", "short_dest", "_coordsystem.json"),
+        ],
+        "sidecar": "_eeg.json",
+    },
+    EEG_BRAINVISION: {
+        "modality": "eeg",
+        "files": [
+            ("eeg.eeg", "dest", "_eeg.eeg"),
+            ("eeg.vhdr", "dest", "_eeg.vhdr"),
+            ("eeg.vmrk", "dest", "_eeg.vmrk"),
+            ("channels.tsv", "dest", "_channels.tsv"),
+            ("events.tsv", "dest", "_events.tsv"),
+            ("events.json", "dest", "_events.json"),
+            ("electrodes.tsv", "short_dest", "_electrodes.tsv"),
+            ("coordsystem.json", "short_dest", "_coordsystem.json"),
+        ],
+        "sidecar": "_eeg.json",
+    },
+    EEG_BDF: {
+        "modality": "eeg",
+        "files": [
+            ("eeg.bdf", "dest", "_eeg.bdf"),
+            ("channels.tsv", "dest", "_channels.tsv"),
+            ("events.tsv", "dest", "_events.tsv"),
+            ("events.json", "dest", "_events.json"),
+            ("electrodes.tsv", "short_dest", "_electrodes.tsv"),
+            ("coordsystem.json", "short_dest", "_coordsystem.json"),
+        ],
+        "sidecar": "_eeg.json",
+    },
+}
+
 def getModality(input):
-    if input["datatype"] == ANAT_T1W:
-        return "anat"
-    if input["datatype"] == ANAT_T2W:
-        return "anat"
-    if input["datatype"] == DWI:
-        return "dwi"
-    if input["datatype"] == FUNC_TASK:
-        return "func"
-    if input["datatype"] == FUNC_REGRESSORS:
-        return "func"
-    if input["datatype"] == FMAP:
-        return "fmap"
-    if input["datatype"] == MEG_CTF:
-        return "meg"
-    if input["datatype"] == MEG_FIF:
-        return "meg"
-    if input["datatype"] == EEG_EEGLAB:
-        return "eeg"
-    if input["datatype"] == EEG_EDF:
-        return "eeg"
-    if input["datatype"] == EEG_BRAINVISION:
-        return "eeg"
-    if input["datatype"] == EEG_BDF:
-        return "eeg"
+    if input["datatype"] in DATATYPES:
+        return DATATYPES[input["datatype"]]["modality"]
     return "derivatives"
 
+#(path, size, mtime) > axis codes, so each nifti header is decompressed only once
+#even though correctPE/determineDir get called several times for the same image
+_orientation_cache = {}
+
+def getOrientation(nii_img):
+    '''
+    Returns axis codes (like ('L', 'A', 'S')) of nii_img
+
+    Only the nifti header is read (and decompressed) - we don't need the image. nibabel
+    is used only if the header can't be parsed by our own reader
+    '''
+    with eventlog.timed("stat", nii_img):
+        st = os.stat(nii_img)
+    key = (os.path.abspath(nii_img), st.st_size, st.st_mtime_ns)
+    if key not in _orientation_cache:
+        try:
+            with eventlog.timed("nifti_header", nii_img):
+                hdr = nifti.readHeader(nii_img)
+            _orientation_cache[key] = nifti.aff2axcodes(nifti.getAffine(hdr))
+        except ValueError as e:
+            print(e, "- falling back to nibabel", file=sys.stderr)
+            try:
+                import nibabel as nib
+            except ImportError:
+                #bl2bids runs on the host (without nibabel) unless BL2BIDS_CONTAINER is set
+                raise ImportError("nibabel is needed to read %s but it's not installed.. set BL2BIDS_CONTAINER=1 to run bl2bids in its container" % nii_img)
+            with eventlog.timed("nibabel_load", nii_img):
+                _orientation_cache[key] = nib.aff2axcodes(nib.load(nii_img).affine)
+    return _orientation_cache[key]
+
+def exists(path):
+    with eventlog.timed("exists", path):
+        return os.path.exists(path)
+
+#(path, size, mtime) > parsed json sidecar
+_json_cache = {}
+
+def loadJSON(path):
+    '''
+    Returns parsed content of json file at path (cached - don't modify the returned dict)
+    '''
+    with eventlog.timed("stat", path):
+        st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if key not in _json_cache:
+        with eventlog.timed("read_json", path), open(path) as f:
+            _json_cache[key] = json.load(f)
+    return _json_cache[key]
+
 def correctPE(input, nii_img, nii_key=None):
 
     #if nii_key in input["meta"]:
@@ -61,10 +233,8 @@ def correctPE(input, nii_img, nii_key=None):
     #    print("Cannot read PhaseEncodingDirection.")
 
     json_sidecar=nii_img[:-6]+"json"
-    if os.path.exists(json_sidecar):
-        with open(json_sidecar) as f:
-            json_sidecar = json.load(f)
-        pe_direction=json_sidecar["PhaseEncodingDirection"]
+    if exists(json_sidecar):
+        pe_direction=loadJSON(json_sidecar)["PhaseEncodingDirection"]
     elif nii_key in input["meta"]:
         pe_direction = input["meta"][nii_key]["PhaseEncodingDirection"]
     elif "PhaseEncodingDirection" in input["meta"]:
@@ -83,8 +253,7 @@ def correctPE(input, nii_img, nii_key=None):
 
     # pe_direction xyz (correction required)
     else:
-        img = nib.load(nii_img)
-        ornt = nib.aff2axcodes(img.affine)
+        ornt = getOrientation(nii_img)
         improper_ax_idcs = {"x": 0, "y": 1, "z": 2}
         axcode = ornt[improper_ax_idcs[pe_direction[0]]]
         axcode_index = improper_ax_idcs[pe_direction[0]]
@@ -130,10 +299,8 @@ def determineDir(input, nii_img, nii_key=None):
     #    print("Cannot read PhaseEncodingDirection.")
 
     json_sidecar=nii_img[:-6]+"json"
-    if os.path.exists(json_sidecar):
-        with open(json_sidecar) as f:
-            json_sidecar = json.load(f)
-        pe_direction=json_sidecar["PhaseEncodingDirection"]
+    if exists(json_sidecar):
+        pe_direction=loadJSON(json_sidecar)["PhaseEncodingDirection"]
     elif nii_key in input["meta"]:
         pe_direction = input["meta"][nii_key]["PhaseEncodingDirection"]
     elif "PhaseEncodingDirection" in input["meta"]:
@@ -141,8 +308,7 @@ def determineDir(input, nii_img, nii_key=None):
     else:
         print("Cannot read PhaseEncodingDirection.")
 
-    img = nib.load(nii_img)
-    ornt = nib.aff2axcodes(img.affine)
+    ornt = getOrientation(nii_img)
 
     axes = (("R", "L"), ("A", "P"), ("S", "I"))
     ax_idcs = {"i": 0, "j": 1, "k": 2}
@@ -168,101 +334,169 @@ def determineDir(input, nii_img, nii_key=None):
 
     return direction
 
-def outputSidecar(path, input):
-    with open(path, 'w') as outfile:
-
-        #remove some meta fields that conflicts
-        #ValueError: Conflicting values found for entity 'datatype' in filename /export/prod/5f1b9122a5b643aa7fa03b8c/5f1b912ca5b6434713a03b8f/bids/sub-10/anat/sub-10_T1w.nii.gz (value='anat') versus its JSON sidecar (value='16'). Please reconcile this discrepancy.
-        if "datatype" in input["meta"]:
-            print("removing datatype key from meta", path)
-            del input["meta"]["datatype"]
-
-        #https://github.com/bids-standard/pybids/issues/687
-        if "run" in input["meta"]:
-            print("removing run from meta", path)
-            del input["meta"]["run"]
-
-        #https://github.com/nipreps/fmriprep/issues/2341
-        if input["datatype"] in [ANAT_T1W, ANAT_T2W, DWI, FUNC_TASK, FUNC_REGRESSORS] and "PhaseEncodingDirection" in input["meta"]:
-            for key in input["_key2path"]:
-                path = input["_key2path"][key]
-                if path.endswith(".nii.gz"):
-                    print("correcting PE for", path)
-                    updated_pe = correctPE(input, path)
-                    input["meta"]["PhaseEncodingDirection"] = updated_pe
-
-        #adjust subject field in sidecar (one dataset has a redundant prefix sub-)
-        #subject = input["meta"]["subject"]
-        #input["meta"]["subject"] = re.sub('sub-', '', subject)
-        
-        #clean subject field in sidecar
-        subject = input["meta"]["subject"]
-        input["meta"]["subject"] = clean(subject)
-        
-        #fix acquisition in sidecar
-        if "acquisition" in input["meta"]:
-            acq = clean(input["meta"]["acquisition"])
-            input["meta"]["acquisition"] = acq
-        elif "acq" in input["meta"]:
-            acq = clean(input["meta"]["acq"])
-            input["meta"]["acq"] = acq
-
-        json.dump(input["meta"], outfile)
-
-def copyJSON(src, dest, override=None):
+def outputSidecar(sidecars, path, input):
+    override = {}
+    remove = []
+
+    #remove some meta fields that conflicts
+    #ValueError: Conflicting values found for entity 'datatype' in filename /export/prod/5f1b9122a5b643aa7fa03b8c/5f1b912ca5b6434713a03b8f/bids/sub-10/anat/sub-10_T1w.nii.gz (value='anat') versus its JSON sidecar (value='16'). Please reconcile this discrepancy.
+    if "datatype" in input["meta"]:
+        print("removing datatype key from meta", path)
+        remove.append("datatype")
+
+    #https://github.com/bids-standard/pybids/issues/687
+    if "run" in input["meta"]:
+        print("removing run from meta", path)
+        remove.append("run")
+
+    #https://github.com/nipreps/fmriprep/issues/2341
+    if input["datatype"] in [ANAT_T1W, ANAT_T2W, DWI, FUNC_TASK, FUNC_REGRESSORS] and "PhaseEncodingDirection" in input["meta"]:
+        for key in input["_key2path"]:
+            nii_img = input["_key2path"][key]
+            if nii_img.endswith(".nii.gz"):
+                print("correcting PE for", nii_img)
+                override["PhaseEncodingDirection"] = correctPE(input, nii_img)
+
+    #adjust subject field in sidecar (one dataset has a redundant prefix sub-)
+    #subject = input["meta"]["subject"]
+    #input["meta"]["subject"] = re.sub('sub-', '', subject)
+
+    #clean subject field in sidecar
+    override["subject"] = clean(input["meta"]["subject"])
+
+    #fix acquisition in sidecar
+    if "acquisition" in input["meta"]:
+        override["acquisition"] = clean(input["meta"]["acquisition"])
+    elif "acq" in input["meta"]:
+        override["acq"] = clean(input["meta"]["acq"])
+
+    stageJSON(sidecars, path, data=input["meta"], override=override, remove=remove, group=input["_id"])
+
+def stageJSON(sidecars, dest, src=None, data=None, override=None, remove=None, group=None):
+    '''
+    Collect the content of output json (dest) in sidecars without writing it
+
+    The first time dest is staged, its content is copied from src json file (or data dict).
+    Fields in override are then set, and fields listed in remove are dropped. Use
+    writeSidecars() to write out each staged json exactly once. group is the input
+    that the json belongs to (see tagInput())
+    '''
+    if dest not in sidecars:
+        if src is not None:
+            if not exists(src):
+                print(src, "not found")
+                return
+            data = loadJSON(src)
+        sidecars[dest] = {"input": group, "data": dict(data or {})}
+    sidecar = sidecars[dest]["data"]
+    if override is not None:
+        sidecar.update(override)
+    if remove is not None:
+        for key in remove:
+            sidecar.pop(key, None)
+
+def writeSidecars(plan, sidecars):
+    #add write_json op for each staged sidecar
+    for dest, sidecar in sidecars.items():
+        plan.append({"op": "write_json", "dest": dest, "data": sidecar["data"], "input": sidecar["input"]})
+
+def tagInput(plan, group):
+    #mark operations that are not yet claimed by any input as belonging to group
+    for op in plan:
+        op.setdefault("input", group)
+
+def mkdir(plan, path):
+    plan.append({"op": "mkdir", "dest": path})
+
+#(dir path, mtime) > {name: os.DirEntry}
+_listing_cache = {}
+
+def listdir(path):
+    '''
+    Returns {name: os.DirEntry} for entries in path (empty if path doesn't exist)
+
+    We do a single scandir for each input directory and look up all expected files from it
+    instead of calling exists/isdir for each of them
+    '''
     try:
-        if os.path.exists(src):
-            with open(src) as infile:
-                config = json.load(infile)
-                if override is not None:
-                    for key in override.keys():
-                        #print("fixing field", key)
-                        config[key] = override[key]
-            with open(dest, 'w') as outfile:
-                print("copying", src, "to", dest, override)
-                json.dump(config, outfile)
-        else:
+        with eventlog.timed("stat", path):
+            key = (os.path.abspath(path), os.stat(path or ".").st_mtime_ns)
+    except FileNotFoundError:
+        return {}
+    if key not in _listing_cache:
+        with eventlog.timed("scandir", path), os.scandir(path or ".") as it:
+            _listing_cache[key] = {entry.name: entry for entry in it}
+    return _listing_cache[key]
+
+def linkFiles(plan, input_dir, files, dests):
+    '''
+    Link each (name, dest key, suffix) in files that exists under input_dir to dests[dest key]+suffix
+    '''
+    listing = listdir(input_dir)
+    for name, dest_key, suffix in files:
+        src = os.path.join(input_dir, name)
+        entry = listing.get(name)
+        if entry is None or not (entry.is_dir() or entry.is_file()):
             print(src, "not found")
-    except FileExistsError:
-        print(dest,"already exist")
+            continue
+        link(plan, src, dests[dest_key]+suffix, isdir=entry.is_dir())
 
-def link(src, dest):
-    try:
-        if os.path.exists(src):
-            if os.path.isdir(src):
-
-                recover = ""
-                depth = len(dest.split("/"))
-                for i in range(1, depth):
-                    recover += "../"
-
-                print("it's directory.. sym-linking (existing)", recover+src, "to (new symlink)", dest)
-                os.symlink(recover+src, dest, True)
-            else:
-                print("hard-linking (existing)", src, "to (new link)", dest)
-                os.link(src, dest)
-        else:
+def link(plan, src, dest, isdir=None):
+    if isdir is None:
+        if not exists(src):
             print(src, "not found")
-    except FileExistsError:
-        print(dest, "already exists (or failed to link)")
+            return
+        with eventlog.timed("isdir", src):
+            isdir = os.path.isdir(src)
+
+    if isdir:
+
+        recover = ""
+        depth = len(dest.split("/"))
+        for i in range(1, depth):
+            recover += "../"
+
+        plan.append({"op": "symlink", "src": recover+src, "dest": dest})
+    else:
+        plan.append({"op": "link", "src": src, "dest": dest})
+
+def intendedFor(targets, acq=None, run=None):
+    '''
+    Returns IntendedFor paths for a fmap from targets ({"path", "acq", "run"}) in its subject/session
+
+    If the fmap has acq (or run) set, only the targets with the same acq (or run) are used, as
+    long as there are any.. otherwise the fmap is intended for all targets in the subject/session
+    '''
+    for field, value in (("acq", acq), ("run", run)):
+        if value is not None:
+            matched = [target for target in targets if target[field] == value]
+            if matched:
+                targets = matched
+    return [target["path"] for target in targets]
 
 def clean(v):
     return re.sub(r'[^a-zA-Z0-9]+', '', v)
 
-def copytree(src, dest):
-    #link(src, dest)
-    os.makedirs(dest)
+def copytree(plan, src, dest, rename=None):
+    #symlink each file in src from dest (named rename(fname) in dest, if rename is given)
+    mkdir(plan, dest)
     recover = "../"
     depth = len(dest.split("/"))
     for i in range(1, depth):
         recover += "../"
-    for fname in os.listdir(src):
-        os.symlink(os.path.join(recover+src, fname), os.path.join(dest, fname))
+    with eventlog.timed("listdir", src):
+        fnames = os.listdir(src)
+    for fname in fnames:
+        dest_fname = rename(fname) if rename else fname
+        plan.append({"op": "symlink", "src": os.path.join(recover+src, fname), "dest": os.path.join(dest, dest_fname)})
+    return fnames
 
-def copyfile_ctf(src, dest):
+def copyfile_ctf(plan, src, dest):
     """Copy and rename CTF files to a new location.
     Parameters
     ----------
+    plan : list
+        Plan to add the mkdir/symlink operations to.
     src : str | pathlib.Path
         Path to the source raw .ds folder.
     dest : str | pathlib.Path
@@ -275,14 +509,14 @@ def copyfile_ctf(src, dest):
     copyfile_eeglab
     copyfile_kit
     """
-    copytree(src, dest)
     # list of file types to rename
     file_types = ('.acq', '.eeg', '.hc', '.hist', '.infods', '.bak',
                   '.meg4', '.newds', '.res4')
-    # Rename files in dest with the name of the dest directory
-    fnames = [f for f in os.listdir(dest) if f.endswith(file_types)]
+    # Name files in dest with the name of the dest directory (symlinks are
+    # created with their final names instead of renaming them afterward)
     bids_folder_name = op.splitext(op.split(dest)[-1])[0]
-    for fname in fnames:
-        ext = op.splitext(fname)[-1]
-        os.rename(op.join(dest, fname),
-                  op.join(dest, bids_folder_name + ext))
+    def rename(fname):
+        if fname.endswith(file_types):
+            return bids_folder_name + op.splitext(fname)[-1]
+        return fname
+    copytree(plan, src, dest, rename)
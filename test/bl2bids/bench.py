@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+#benchmarks bl2bids on synthetic task directories
+#
+#usage: ./bench.py [-s small -s large ..] [-r 3] [-o results.json]
+#       ./bench.py --inputs 2000 --subjects 200 --sessions 2 --fmaps 1 --ctf-files 0 (custom scenario)
+#       ./bench.py --compare old.json new.json
+#
+#each scenario generates config.json and an input tree (tiny files - we only care about the
+#filesystem operations), then runs bl2bids.py on it twice. "full" is a conversion from scratch and
+#"rerun" is a conversion with nothing changed (see manifest.py). For each, we record the wall time
+#(of each repeat), peak RSS, and the number of stat/open/link/etc.. syscalls (if strace is installed).
+#Results are written as json so that they can be compared between versions with --compare.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BL2BIDS = os.path.join(os.path.dirname(os.path.realpath(__file__)), "../../hooks/bl2bids.py")
+
+ANAT_T1W = "58c33bcee13a50849b25879a"
+DWI = "58c33c5fe13a50849b25879b"
+FUNC_TASK = "59b685a08e5d38b0b331ddc5"
+FMAP = "5c390505f9109beac42b00df"
+MEG_CTF = "6000714baacf9e22a6a691c8"
+
+#inputs: number of inputs, subjects/sessions: how inputs are spread, fmaps: fmap inputs per session
+#ctf_files: number of files in each CTF .ds directory (0 for no meg inputs)
+SCENARIOS = {
+    "small": {"inputs": 10, "subjects": 2, "sessions": 1, "fmaps": 1, "ctf_files": 0},
+    "medium": {"inputs": 500, "subjects": 50, "sessions": 2, "fmaps": 1, "ctf_files": 20},
+    "large": {"inputs": 5000, "subjects": 500, "sessions": 2, "fmaps": 2, "ctf_files": 20},
+    "sessions": {"inputs": 2000, "subjects": 20, "sessions": 25, "fmaps": 2, "ctf_files": 0},
+    "ctf": {"inputs": 50, "subjects": 10, "sessions": 1, "fmaps": 0, "ctf_files": 2000},
+}
+
+#syscalls we count (grouped by what they are used for)
+SYSCALLS = {
+    "stat": ["stat", "lstat", "fstat", "newfstatat", "statx", "fstatat64", "access", "faccessat", "faccessat2"],
+    "open": ["open", "openat", "openat2"],
+    "link": ["link", "linkat", "symlink", "symlinkat"],
+    "rename": ["rename", "renameat", "renameat2"],
+    "mkdir": ["mkdir", "mkdirat"],
+    "unlink": ["unlink", "unlinkat", "rmdir"],
+    "readdir": ["getdents", "getdents64"],
+}
+
+def touch(path, content=""):
+    with open(path, "w") as f:
+        f.write(content)
+
+def generate(root, scenario):
+    '''
+    Creates config.json and input files under root for scenario
+    '''
+    config = {}
+    inputs = []
+    counts = {} #(subject, session, kind) > number of inputs so far (used as run)
+
+    def add(kind, datatype, files, subject, session, meta=None):
+        n = counts[(subject, session, kind)] = counts.get((subject, session, kind), 0) + 1
+        dirname = os.path.join("testdata", "%s-%d" % (kind, len(inputs)))
+        os.makedirs(os.path.join(root, dirname))
+        keys = []
+        for key, name, content in files:
+            path = os.path.join(dirname, name)
+            if content is not None:
+                touch(os.path.join(root, path), content)
+            config.setdefault(key, []).append(path)
+            keys.append(key)
+        meta = dict(meta or {}, subject="%03d" % subject, run=str(n))
+        if scenario["sessions"] > 1:
+            meta["session"] = str(session+1)
+        inputs.append({"id": kind, "datatype": datatype, "meta": meta, "keys": keys, "tags": [], "datatype_tags": []})
+        return dirname
+
+    fmap_json = json.dumps({"PhaseEncodingDirection": "j-", "EchoTime1": 0.00492, "EchoTime2": 0.00738})
+    kinds = ["t1", "bold", "dwi"]
+    if scenario["ctf_files"]:
+        kinds.append("ctf")
+
+    slots = [(subject, session) for subject in range(scenario["subjects"]) for session in range(scenario["sessions"])]
+    total = scenario["inputs"]
+    for i in range(total):
+        subject, session = slots[i % len(slots)]
+        if counts.get((subject, session, "fmap"), 0) < scenario["fmaps"]:
+            add("fmap", FMAP, [
+                ("phasediff", "phasediff.nii.gz", "x"),
+                ("phasediff_json", "phasediff.json", fmap_json),
+                ("magnitude1", "magnitude1.nii.gz", "x"),
+                ("magnitude2", "magnitude2.nii.gz", "x"),
+            ], subject, session)
+            continue
+        kind = kinds[(i // len(slots)) % len(kinds)]
+        if kind == "t1":
+            add(kind, ANAT_T1W, [("t1", "t1.nii.gz", "x")], subject, session)
+        elif kind == "bold":
+            add(kind, FUNC_TASK, [
+                ("bold", "bold.nii.gz", "x"),
+                ("events", "events.tsv", "onset\tduration\n"),
+                ("events_json", "events.json", "{}"),
+            ], subject, session, {"task": "bench"})
+        elif kind == "dwi":
+            add(kind, DWI, [
+                ("dwi", "dwi.nii.gz", "x"),
+                ("bvals", "dwi.bvals", "0 1000"),
+                ("bvecs", "dwi.bvecs", "0 1"),
+            ], subject, session)
+        else:
+            dirname = add(kind, MEG_CTF, [
+                ("meg", "meg.ds", None),
+                ("channels", "channels.tsv", "name\ttype\n"),
+            ], subject, session, {"task": "bench"})
+            ds = os.path.join(root, dirname, "meg.ds")
+            os.makedirs(ds)
+            exts = [".meg4", ".res4", ".hc", ".infods", ".acq", ".hist", ".txt", ".cfg"]
+            for j in range(scenario["ctf_files"]):
+                touch(os.path.join(ds, "f%d%s" % (j, exts[j % len(exts)])), "x")
+
+    config["_inputs"] = inputs
+    with open(os.path.join(root, "config.json"), "w") as f:
+        json.dump(config, f)
+
+def run(root, strace=None):
+    '''
+    Runs bl2bids.py in root. Returns (wall seconds, peak rss in KB)
+    '''
+    cmd = [sys.executable, BL2BIDS]
+    if strace:
+        calls = sorted(sum(SYSCALLS.values(), []))
+        cmd = [strace, "-f", "-c", "-o", os.path.join(root, "_strace"), "-e", "trace="+",".join(calls)] + cmd
+    with open(os.path.join(root, "_stderr"), "w+") as err:
+        start = time.monotonic()
+        p = subprocess.Popen(cmd, cwd=root, stdout=subprocess.DEVNULL, stderr=err)
+        #wait4 gives us the rusage of this run alone (RUSAGE_CHILDREN would be the max of all runs)
+        _, status, rusage = os.wait4(p.pid, 0)
+        wall = time.monotonic() - start
+        if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+            err.seek(0)
+            raise RuntimeError("bl2bids failed in %s\n%s" % (root, err.read()))
+    return wall, rusage.ru_maxrss
+
+def count_syscalls(path):
+    '''
+    Parses strace -c summary. Returns {group: calls}
+    '''
+    calls = {}
+    with open(path) as f:
+        for line in f:
+            tokens = line.split()
+            #% time, seconds, usecs/call, calls, [errors], syscall
+            if len(tokens) >= 5 and tokens[0][0].isdigit() and tokens[3].isdigit():
+                calls[tokens[-1]] = int(tokens[3])
+    return dict((group, sum(calls.get(name, 0) for name in names)) for group, names in SYSCALLS.items())
+
+def reset(root):
+    shutil.rmtree(os.path.join(root, "bids"), ignore_errors=True)
+    for name in ("_bl2bids.manifest.json", "_strace", "_stderr"):
+        if os.path.exists(os.path.join(root, name)):
+            os.remove(os.path.join(root, name))
+
+def bench(root, repeat, strace):
+    results = {"full": {"wall": []}, "rerun": {"wall": []}}
+    for i in range(repeat):
+        reset(root)
+        for phase in ("full", "rerun"):
+            wall, maxrss = run(root)
+            results[phase]["wall"].append(round(wall, 4))
+            results[phase]["maxrss_kb"] = max(results[phase].get("maxrss_kb", 0), maxrss)
+
+    #count syscalls separately so that strace overhead doesn't affect the timing
+    for phase in ("full", "rerun"):
+        results[phase]["syscalls"] = None
+    if strace:
+        reset(root)
+        for phase in ("full", "rerun"):
+            run(root, strace)
+            results[phase]["syscalls"] = count_syscalls(os.path.join(root, "_strace"))
+
+    for phase in results.values():
+        wall = sorted(phase["wall"])
+        phase["wall_min"] = wall[0]
+        phase["wall_median"] = wall[len(wall)//2]
+    return results
+
+def version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(BL2BIDS), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old_path, new_path, threshold):
+    '''
+    Prints change of each metric between two result files. Returns number of regressions
+    '''
+    with open(old_path) as f:
+        old = dict((s["name"], s) for s in json.load(f)["scenarios"])
+    with open(new_path) as f:
+        new = json.load(f)["scenarios"]
+    regressions = 0
+    for scenario in new:
+        if scenario["name"] not in old:
+            continue
+        for phase, result in scenario["results"].items():
+            before = old[scenario["name"]]["results"].get(phase)
+            if not before:
+                continue
+            metrics = [("wall_min", result["wall_min"], before["wall_min"]), ("maxrss_kb", result["maxrss_kb"], before["maxrss_kb"])]
+            for group, calls in (result["syscalls"] or {}).items():
+                metrics.append(("syscalls."+group, calls, (before["syscalls"] or {}).get(group)))
+            for name, value, previous in metrics:
+                if not previous:
+                    continue
+                ratio = value / previous
+                flag = ""
+                if ratio > 1 + threshold:
+                    flag = "  <-- regression"
+                    regressions += 1
+                print("%-10s %-6s %-18s %12s -> %12s (%+.1f%%)%s" % (scenario["name"], phase, name, previous, value, (ratio-1)*100, flag))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark bl2bids on synthetic task directories")
+    parser.add_argument("-s", "--scenario", action="append", choices=sorted(SCENARIOS), help="scenario to run (default: small and medium)")
+    parser.add_argument("--inputs", type=int, help="run a custom scenario with this many inputs")
+    parser.add_argument("--subjects", type=int, default=10)
+    parser.add_argument("--sessions", type=int, default=1)
+    parser.add_argument("--fmaps", type=int, default=1, help="fmap inputs per subject/session")
+    parser.add_argument("--ctf-files", type=int, default=0, help="files in each CTF .ds directory (0 for no meg inputs)")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="number of timed runs for each scenario")
+    parser.add_argument("-o", "--output", help="write results to this file (default: stdout)")
+    parser.add_argument("--workdir", help="generate task directories here (and keep them)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative increase reported as regression by --compare")
+    args = parser.parse_args()
+
+    if args.compare:
+        if compare(args.compare[0], args.compare[1], args.threshold) > 0:
+            sys.exit(1)
+        return
+
+    scenarios = [(name, SCENARIOS[name]) for name in (args.scenario or [])]
+    if args.inputs:
+        scenarios.append(("custom", {"inputs": args.inputs, "subjects": args.subjects, "sessions": args.sessions,
+            "fmaps": args.fmaps, "ctf_files": args.ctf_files}))
+    if not scenarios:
+        scenarios = [(name, SCENARIOS[name]) for name in ("small", "medium")]
+
+    strace = shutil.which("strace")
+    if not strace:
+        print("strace not found.. syscalls won't be counted", file=sys.stderr)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bl2bids-bench.")
+    results = {
+        "version": version(),
+        "python": platform.python_version(),
+        "host": platform.node(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "scenarios": [],
+    }
+    try:
+        for name, scenario in scenarios:
+            root = os.path.join(workdir, name)
+            shutil.rmtree(root, ignore_errors=True)
+            os.makedirs(root)
+            print("generating", name, scenario, file=sys.stderr)
+            generate(root, scenario)
+            print("running", name, file=sys.stderr)
+            result = dict(scenario, name=name, results=bench(root, args.repeat, strace))
+            results["scenarios"].append(result)
+            print(name, "full: %.2fs rerun: %.2fs" % (result["results"]["full"]["wall_min"], result["results"]["rerun"]["wall_min"]), file=sys.stderr)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    else:
+        json.dump(results, sys.stdout, indent=4)
+        print()
+
+if __name__ == "__main__":
+    main()
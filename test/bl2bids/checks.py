@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+#checks for the modules that bl2bids.py uses (run by run.sh before converting the inputs)
+#
+#usage: ./checks.py [name ..] (runs all checks if no name is given)
+#
+#  nifti    : affine / axis codes read from the headers in fixtures/nifti (sform, qform, and neither
+#             set) match what nibabel computed for them (fixtures/nifti/expected.json)
+#  manifest : select() skips inputs that didn't change, re-generates the ones that did, and
+#             prune() removes directories left empty by outputs that are no longer generated
+#  place    : executor.place() falls back from hard-link to the next method when os.link fails
+#             with EXDEV, and remembers it for the next file between the same filesystems
+
+import contextlib
+import errno
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+from unittest import mock
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(HERE, "../../hooks"))
+
+import executor
+import manifest
+import nifti
+
+def touch(path, content=""):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+def check_nifti():
+    fixtures = os.path.join(HERE, "fixtures/nifti")
+    with open(os.path.join(fixtures, "expected.json")) as f:
+        expected = json.load(f)
+    for name, exp in expected.items():
+        affine = nifti.getAffine(nifti.readHeader(os.path.join(fixtures, name)))
+        for row, exp_row in zip(affine, exp["affine"]):
+            for v, exp_v in zip(row, exp_row):
+                assert abs(v - exp_v) < 1e-3, "%s: affine %s != %s" % (name, affine, exp["affine"])
+        axcodes = list(nifti.aff2axcodes(affine))
+        assert axcodes == exp["axcodes"], "%s: axcodes %s != %s" % (name, axcodes, exp["axcodes"])
+
+def plan_for(inputs):
+    #plan like bl2bids generates (input id > (src, dest))
+    plan = [{"op": "mkdir", "dest": "bids"}]
+    for group, (src, dest) in inputs.items():
+        plan.append({"op": "mkdir", "dest": os.path.dirname(dest), "input": group})
+        plan.append({"op": "link", "src": src, "dest": dest, "input": group})
+        plan.append({"op": "write_json", "dest": dest.split(".")[0]+".json", "data": {"input": group}, "input": group})
+    return plan
+
+def convert(plan):
+    #same steps as bl2bids.convert() (without the plan generation)
+    ops, remove, current = manifest.select(plan, manifest.load())
+    ops = [{"op": "remove", "dest": path} for path in remove] + ops
+    executor.execute(ops, threads=2)
+    manifest.prune(remove)
+    manifest.save(current)
+    return ops, remove
+
+def check_manifest():
+    inputs = {
+        "t1.1": ("testdata/t1.nii.gz", "bids/sub-01/anat/sub-01_T1w.nii.gz"),
+        "dwi.1": ("testdata/dwi.nii.gz", "bids/sub-01/dwi/sub-01_dwi.nii.gz"),
+    }
+    touch("testdata/t1.nii.gz", "t1")
+    touch("testdata/dwi.nii.gz", "dwi")
+
+    ops, remove = convert(plan_for(inputs))
+    assert remove == [], remove
+    assert all(op.get("replace") for op in ops if op["op"] != "mkdir"), "first run should generate everything"
+    assert read("bids/sub-01/anat/sub-01_T1w.nii.gz") == "t1"
+
+    #nothing changed.. both inputs are skipped
+    ops, remove = convert(plan_for(inputs))
+    assert [op for op in ops if op["op"] != "mkdir"] == [], ops
+    assert remove == [], remove
+
+    #input file changed (size/mtime) .. only that input is re-generated
+    touch("testdata/dwi.nii.gz", "dwi (updated)")
+    ops, remove = convert(plan_for(inputs))
+    groups = set(op["input"] for op in ops if op["op"] != "mkdir")
+    assert groups == {"dwi.1"}, groups
+    assert read("bids/sub-01/dwi/sub-01_dwi.nii.gz") == "dwi (updated)"
+
+    #input now goes to another subject.. old outputs are removed and their empty directories pruned
+    inputs["dwi.1"] = ("testdata/dwi.nii.gz", "bids/sub-02/dwi/sub-02_dwi.nii.gz")
+    ops, remove = convert(plan_for(inputs))
+    assert sorted(remove) == ["bids/sub-01/dwi/sub-01_dwi.json", "bids/sub-01/dwi/sub-01_dwi.nii.gz"], remove
+    assert not os.path.exists("bids/sub-01/dwi"), "empty directory was not pruned"
+    assert os.path.exists("bids/sub-01/anat/sub-01_T1w.nii.gz"), "unchanged input was removed"
+    assert read("bids/sub-02/dwi/sub-02_dwi.nii.gz") == "dwi (updated)"
+
+    #input is gone.. its outputs are removed up to (but not including) bids/
+    del inputs["dwi.1"]
+    ops, remove = convert(plan_for(inputs))
+    assert not os.path.exists("bids/sub-02"), "empty subject directory was not pruned"
+    assert os.path.isdir("bids")
+
+def check_place():
+    touch("src/a.nii.gz", "a")
+    touch("src/b.nii.gz", "b")
+    os.makedirs("dest")
+    executor._capability.clear()
+
+    link = mock.Mock(side_effect=OSError(errno.EXDEV, "Invalid cross-device link"))
+    reflink = mock.Mock(side_effect=OSError(errno.EXDEV, "Invalid cross-device link"))
+    symlink = mock.Mock(side_effect=OSError(errno.EPERM, "Operation not permitted"))
+    with mock.patch("os.link", link), mock.patch("executor.reflink", reflink), mock.patch("os.symlink", symlink):
+        #hard-link (and reflink) not possible across filesystems, and symlink not allowed.. copy
+        method = executor.place("src/a.nii.gz", "dest/a.nii.gz")
+        assert method == "copy", method
+        assert read("dest/a.nii.gz") == "a"
+        assert not os.path.islink("dest/a.nii.gz")
+        assert os.stat("dest/a.nii.gz").st_ino != os.stat("src/a.nii.gz").st_ino
+
+        #EXDEV is remembered for this pair of filesystems.. hard-link/reflink are not tried again
+        #(EPERM from symlink could be about the file, so symlink is still tried)
+        link.reset_mock()
+        reflink.reset_mock()
+        symlink.reset_mock()
+        method = executor.place("src/b.nii.gz", "dest/b.nii.gz")
+        assert method == "copy", method
+        assert not link.called and not reflink.called, "unsupported methods were tried again"
+        assert symlink.called
+        assert read("dest/b.nii.gz") == "b"
+
+    #hard-link works again on a fresh probe
+    executor._capability.clear()
+    os.remove("dest/a.nii.gz")
+    assert executor.place("src/a.nii.gz", "dest/a.nii.gz") == "hardlink"
+    assert os.stat("dest/a.nii.gz").st_ino == os.stat("src/a.nii.gz").st_ino
+
+CHECKS = {
+    "nifti": check_nifti,
+    "manifest": check_manifest,
+    "place": check_place,
+}
+
+def main():
+    names = sys.argv[1:] or list(CHECKS)
+    failed = []
+    for name in names:
+        cwd = os.getcwd()
+        workdir = tempfile.mkdtemp(prefix="bl2bids-check-")
+        os.chdir(workdir)
+        out = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(out):
+                CHECKS[name]()
+            print(name, "ok")
+        except Exception:
+            print(name, "FAILED")
+            print(out.getvalue(), end="")
+            traceback.print_exc()
+            failed.append(name)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workdir)
+    if failed:
+        print("---> ERROR: checks failed:", " ".join(failed))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,9 @@
 
 set -e
 
+#check the modules that bl2bids uses (nifti.py, manifest.py, executor.py) first
+./checks.py
+
 for dir in $(ls inputs)
 #for dir in simple
 do
@@ -14,7 +17,7 @@ do
 
   (
     cd inputs/$dir
-    rm -rf bids
+    rm -rf bids _bl2bids.manifest.json
     rm -f output
     ../../../../hooks/bl2bids 
 
@@ -0,0 +1,4 @@
+#!/bin/bash
+echo "#PBS -l vmem=8gb"
+echo "module load singularity"
+exit 1
@@ -0,0 +1,2 @@
+#!/bin/bash
+echo "#SBATCH -p short"
@@ -0,0 +1,39 @@
+#!/bin/bash
+
+#compiles headers in inputs/*/main (and jobheader.sh) for each scheduler and compares them to expected-<scheduler>
+#(run with -u to update the expected output). IGNORE_* env for an input can be set in inputs/*/env
+
+set -e
+
+hooks=$(realpath ../../hooks)
+
+#don't let cluster policy of this host or IGNORE_* env change the output
+unset IGNORE_PPN IGNORE_VMEM IGNORE_NODES
+
+for dir in $(ls inputs)
+do
+  for backend in slurm pbs osg
+  do
+    echo "$dir ($backend)"
+    (
+      cd inputs/$dir
+      [ -f env ] && export $(cat env)
+      python3 - $hooks $backend > output-$backend 2>&1 <<PYTHON
+import sys
+sys.path.insert(0, sys.argv[1])
+import jobheader
+extra = []
+lines = jobheader.read_headers(".", extra)
+for line in jobheader.compile(lines, sys.argv[2], jobheader.load_policy("localhost"), extra):
+    print(line)
+PYTHON
+      [ "$1" == "-u" ] && cp output-$backend expected-$backend
+      if ! diff expected-$backend output-$backend; then
+        echo "---> ERROR: Test failed." && exit 1
+      fi
+      rm output-$backend
+    )
+  done
+done
+
+echo "all test ran successfully"